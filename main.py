@@ -2,8 +2,8 @@
 from fastapi import FastAPI, HTTPException
 from pydantic import BaseModel
 from openai import OpenAI
+import asyncio
 import os
-from typing import Dict, List, Tuple
 
 from smogon_utils import (
     fetch_usage_text,
@@ -12,10 +12,8 @@ from smogon_utils import (
     banned_sleep_moves,
     banned_evasion_items,
     tera_allowed_for_format,
-    load_moveset_db,
-    normalize_moveset_entry,
-    fetch_dex_ou_summary,
-    parse_spread_key,
+    load_normalized_moveset_db,
+    build_candidate_context,
 )
 from teamgen import (
     build_planner_prompt,
@@ -38,55 +36,7 @@ class GenerateReq(BaseModel):
     temperature: float = 0.35
     api_key: str | None = None
     top_k: int = 32  # number of candidate mons to include in context
-
-def _build_candidate_context(
-    usage: Dict[str, Dict[str, float]],
-    moveset_db_raw: Dict[str, Dict],
-    user_prompt: str,
-    top_k: int = 32,
-) -> str:
-    """
-    Same idea as the Streamlit app: compact per-mon blocks to guide the planner.
-    """
-    mentioned: List[str] = []
-    up = (user_prompt or "").lower()
-    for mon in usage.keys():
-        if mon.lower() in up:
-            mentioned.append(mon)
-
-    top_list = [name for name, _ in sorted(usage.items(), key=lambda kv: kv[1]['rank'])[:top_k]]
-    cands: List[str] = []
-    for m in mentioned + top_list:
-        if m not in cands:
-            cands.append(m)
-
-    blocks: List[str] = []
-    for mon in cands[:top_k+len(mentioned)]:
-        dex_summary = fetch_dex_ou_summary(mon) or ""
-        ms = normalize_moveset_entry(moveset_db_raw.get(mon, {}), top_n_moves=12)
-
-        items = ", ".join([f"{k}" for k,_ in (ms.get("items") or [])[:3]]) or "-"
-        abilities = ", ".join([f"{k}" for k,_ in (ms.get("abilities") or [])[:2]]) or "-"
-        nats = []
-        for sp,_ in (ms.get("spreads") or [])[:2]:
-            nat, _ = parse_spread_key(sp)
-            nats.append(nat)
-        natures = ", ".join(dict.fromkeys(nats)) or "-"
-        moves = ", ".join([k for k,_ in (ms.get("moves") or [])[:8]]) or "-"
-        tera = ", ".join([k for k,_ in (ms.get("tera") or [])[:3]]) or "-"
-        mates = ", ".join([k for k,_ in (ms.get("teammates") or [])[:8]]) or "-"
-        checks = ", ".join([k for k,_ in (ms.get("checks") or [])[:8]]) or "-"
-
-        block = (
-            f"=== {mon} ===\n"
-            f"[DEX OU SUMMARY]\n{dex_summary}\n"
-            f"[STATS] Items: {items} | Abilities: {abilities} | Natures: {natures} | "
-            f"Moves: {moves} | Tera: {tera}\n"
-            f"Teammates: {mates}\n"
-            f"Checks/Counters: {checks}\n"
-        )
-        blocks.append(block)
-    return "\n".join(blocks)
+    use_cache: bool = True  # reuse a cached plan for identical low-temperature inputs
 
 @app.post("/generate")
 async def generate(req: GenerateReq):
@@ -95,25 +45,23 @@ async def generate(req: GenerateReq):
         raise HTTPException(400, "Missing API key")
     client = OpenAI(api_key=key)
 
-    # Usage + allowed species
-    _, text = fetch_usage_text(req.month, req.fmt, req.ladder)
+    # Usage + normalized moveset DB (for stats fill-ins) are independent blocking
+    # fetches: run them in worker threads concurrently so the event loop stays free
+    (_, text), moveset_db = await asyncio.gather(
+        asyncio.to_thread(fetch_usage_text, req.month, req.fmt, req.ladder),
+        asyncio.to_thread(load_normalized_moveset_db, req.month, req.fmt, req.ladder, top_n_moves=20),
+    )
     usage = parse_usage_file(text)
     allowed = get_allowed_species_from_usage(usage)
 
-    # Moveset DB raw (for stats fill-ins)
-    moveset_db_raw = load_moveset_db(req.month, req.fmt, req.ladder)
-    moveset_db: Dict[str, Dict] = {}
-    for mon, entry in moveset_db_raw.items():
-        moveset_db[mon] = normalize_moveset_entry(entry, top_n_moves=20)
-
     # Candidate context (Dex + stats) → planner prompts
-    cand_ctx = _build_candidate_context(usage, moveset_db_raw, req.prompt, top_k=req.top_k)
+    cand_ctx = await asyncio.to_thread(build_candidate_context, usage, moveset_db, req.prompt, top_k=req.top_k)
     sys_p, usr_p = build_planner_prompt(
         req.fmt, req.month, req.ladder, req.prompt, cand_ctx, req.ev_target, (tera_allowed_for_format(req.fmt) and req.allow_tera)
     )
 
     # LLM plan → JSON
-    raw_plan = call_llm_for_team(client, sys_p, usr_p, temperature=req.temperature)
+    raw_plan = await asyncio.to_thread(call_llm_for_team, client, sys_p, usr_p, temperature=req.temperature, use_cache=req.use_cache)
     plan = extract_plan_json(raw_plan)
 
     # Plan → sets (fill via stats if missing)
@@ -1,73 +1,199 @@
 # smogon_utils.py
+import heapq
+import itertools
 import json
+import os
 import re
+import shelve
+import sys
+import threading
+import time
 import requests
-from typing import Dict, List, Tuple, Set, Optional
-from bs4 import BeautifulSoup
+from collections import OrderedDict
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from operator import itemgetter
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from typing import Any, Dict, FrozenSet, List, Tuple, Optional
+from lxml import html as lxml_html
+
+try:
+    import orjson  # optional; much faster on the multi-MB chaos JSON
+    _json_loads = orjson.loads
+except ImportError:
+    _json_loads = json.loads
 
 USAGE_BASE = "https://www.smogon.com/stats/{month}/{fmt}-{ladder}.txt"
 CHAOS_JSON = "https://www.smogon.com/stats/{month}/chaos/{fmt}-{ladder}.json"
 MOVESET_TXT = "https://www.smogon.com/stats/{month}/moveset/{fmt}-{ladder}.txt"
 DEX_OU_URL = "https://www.smogon.com/dex/sv/pokemon/{slug}/ou/"
 
+# On-disk cache for scraped/fetched Smogon data (override with SMOGON_CACHE_DIR)
+CACHE_DIR = os.path.expanduser(os.getenv("SMOGON_CACHE_DIR", "~/.cache/smogon"))
+DEX_CACHE_TTL = 7 * 24 * 3600  # Dex analyses rarely change
+DEX_MISS_TTL = 24 * 3600  # no analysis / nothing extractable; retried sooner
+STATS_CACHE_TTL = 30 * 24 * 3600  # past months are final
+STATS_CACHE_TTL_RECENT = 24 * 3600  # latest month may still be (re)published
+STATS_MISS_TTL = 3600  # no moveset file (404) yet; a new month may appear any time
+
+# e.g. " | 1    | Great Tusk          | 33.30% | ..."
+_USAGE_LINE_RE = re.compile(r"^[ \t]*\|\s*(\d+)\s*\|\s*([^|\n]+?)\s*\|\s*([0-9.]+)%\s*\|", re.M)
+_SLUG_RE = re.compile(r"[^a-z0-9\-]")
+# Accent fold + space→hyphen in one pass ("Flabébé" → "flabebe", not "flabb")
+_SLUG_TRANS = str.maketrans({"á": "a", "é": "e", "í": "i", "ó": "o", "ú": "u", " ": "-"})
+
+# One pooled keep-alive session for every smogon.com fetch (shared across threads)
+_SESSION = requests.Session()
+_SESSION.mount("https://", HTTPAdapter(
+    pool_connections=16,
+    pool_maxsize=32,
+    max_retries=Retry(total=2, backoff_factor=0.2, status_forcelist=(502, 503, 504), raise_on_status=False),
+))
+
 # Sleep moves ban list (SV OU)
-SLEEP_MOVES = {
+SLEEP_MOVES = frozenset({
     "Dark Void", "Grass Whistle", "Hypnosis", "Lovely Kiss", "Sing", "Sleep Powder", "Spore", "Yawn"
-}
+})
 # Evasion Items clause
-EVASION_ITEMS = {"Bright Powder", "Lax Incense"}
+EVASION_ITEMS = frozenset({"Bright Powder", "Lax Incense"})
+
+# -----------------------
+# Cache (in-memory, backed by a shelve file per namespace)
+# -----------------------
+_CACHE_LOCK = threading.Lock()
+# LRU-bounded: a long-running server sees an open-ended stream of LLM prompt keys
+_MEM_CACHE: "OrderedDict[Tuple[str, str], Tuple[float, Any]]" = OrderedDict()
+MEM_CACHE_MAX_ENTRIES = 512
+
+def _mem_put(mkey: Tuple[str, str], entry: Tuple[float, Any]) -> None:
+    # caller holds _CACHE_LOCK
+    _MEM_CACHE[mkey] = entry
+    _MEM_CACHE.move_to_end(mkey)
+    while len(_MEM_CACHE) > MEM_CACHE_MAX_ENTRIES:
+        _MEM_CACHE.popitem(last=False)
+
+def cache_get(namespace: str, key: str, ttl: float) -> Optional[Any]:
+    """Return a cached value younger than `ttl` seconds, or None on miss; stale entries are evicted."""
+    now = time.time()
+    mkey = (namespace, key)
+    with _CACHE_LOCK:
+        hit = _MEM_CACHE.get(mkey)
+        if hit is not None:
+            _MEM_CACHE.move_to_end(mkey)
+        else:
+            try:
+                os.makedirs(CACHE_DIR, exist_ok=True)
+                with shelve.open(os.path.join(CACHE_DIR, namespace)) as db:
+                    hit = db.get(key)
+            except Exception:
+                hit = None
+            if hit is not None:
+                _mem_put(mkey, hit)
+        if hit is not None and now - hit[0] > ttl:
+            _MEM_CACHE.pop(mkey, None)
+            try:
+                with shelve.open(os.path.join(CACHE_DIR, namespace)) as db:
+                    db.pop(key, None)
+            except Exception:
+                pass
+            return None
+    if hit is None:
+        return None
+    return hit[1]
+
+def cache_set(namespace: str, key: str, value: Any) -> None:
+    """Store `value` in memory and on disk; disk errors are ignored."""
+    entry = (time.time(), value)
+    with _CACHE_LOCK:
+        _mem_put((namespace, key), entry)
+        try:
+            os.makedirs(CACHE_DIR, exist_ok=True)
+            with shelve.open(os.path.join(CACHE_DIR, namespace)) as db:
+                db[key] = entry
+        except Exception:
+            pass
+
+def _stats_ttl(month: str) -> float:
+    last_month = time.strftime("%Y-%m", time.gmtime(time.time() - 32 * 24 * 3600))
+    return STATS_CACHE_TTL_RECENT if month >= last_month else STATS_CACHE_TTL
 
 # -----------------------
 # Usage list (species + ranks)
 # -----------------------
 def fetch_usage_text(month: str, fmt: str, ladder: str) -> Tuple[str, str]:
     url = USAGE_BASE.format(month=month, fmt=fmt, ladder=ladder)
-    r = requests.get(url, timeout=20)
+    cached = cache_get("usage", url, _stats_ttl(month))
+    if cached is not None:
+        return url, cached
+    r = _SESSION.get(url, timeout=20)
     r.raise_for_status()
+    cache_set("usage", url, r.text)
     return url, r.text
 
 def parse_usage_file(text: str) -> Dict[str, Dict[str, float]]:
-    usage: Dict[str, Dict[str, float]] = {}
-    line_re = re.compile(r"\|\s*(\d+)\s*\|\s*([^|]+?)\s*\|\s*([0-9.]+)%\s*\|")
-    for line in text.splitlines():
-        m = line_re.search(line)
-        if m:
-            rank = int(m.group(1))
-            name = m.group(2).strip()
-            pct = float(m.group(3))
-            usage[name] = {"rank": rank, "usage": pct}
-    return usage
-
-def get_allowed_species_from_usage(usage: Dict[str, Dict[str, float]]) -> Set[str]:
-    return set(usage.keys())
+    # One multiline finditer pass; the regex engine drives the loop.
+    # Names are interned so later set/dict lookups can hit on identity.
+    return {
+        sys.intern(m.group(2).strip()): {"rank": int(m.group(1)), "usage": float(m.group(3))}
+        for m in _USAGE_LINE_RE.finditer(text)
+    }
+
+def get_allowed_species_from_usage(usage: Dict[str, Dict[str, float]]) -> FrozenSet[str]:
+    # frozenset: immutable, so it's safe to cache and share across threads/requests
+    return frozenset(usage)
+
+def species_by_rank(usage: Dict[str, Dict[str, float]], n: Optional[int] = None) -> List[str]:
+    """Species names ordered by usage rank (best first); only the top `n` if given."""
+    def rank(name: str) -> float:
+        return usage[name]["rank"]
+    if n is None:
+        return sorted(usage, key=rank)
+    return heapq.nsmallest(n, usage, key=rank)
+
+@lru_cache(maxsize=4)
+def _lowered_names(names: Tuple[str, ...]) -> Tuple[Tuple[str, str], ...]:
+    return tuple((n.lower(), n) for n in names)
+
+def mentioned_species(usage: Dict[str, Dict[str, float]], text: str) -> List[str]:
+    """Species from `usage` whose name appears (case-insensitively) in `text`."""
+    up = (text or "").lower()
+    if not up:
+        return []
+    # Substring test (not tokens) so multi-word/forme names like "Iron Valiant" still match
+    return [orig for low, orig in _lowered_names(tuple(usage)) if low in up]
 
 # -----------------------
 # Chaos / moveset stats (per-Pokémon structure)
 # -----------------------
 def fetch_moveset_chaos(month: str, fmt: str, ladder: str) -> Optional[Dict]:
-    """Try to load the OU 'chaos' JSON (best source)."""
+    """
+    Try to load the OU 'chaos' JSON (best source). None if the file doesn't exist (404);
+    network/server/parse errors raise.
+    """
     url = CHAOS_JSON.format(month=month, fmt=fmt, ladder=ladder)
-    try:
-        r = requests.get(url, timeout=30)
-        r.raise_for_status()
-        return r.json()
-    except Exception:
+    r = _SESSION.get(url, timeout=30)
+    if r.status_code == 404:
         return None
+    r.raise_for_status()
+    return _json_loads(r.content)
 
 def fetch_moveset_fallback(month: str, fmt: str, ladder: str) -> Optional[Dict]:
     """
     Fallback to moveset TXT which is actually JSON per month/format nowadays.
+    None on 404, like fetch_moveset_chaos; other errors raise.
     """
     url = MOVESET_TXT.format(month=month, fmt=fmt, ladder=ladder)
-    try:
-        r = requests.get(url, timeout=30)
-        r.raise_for_status()
-        txt = r.text.strip()
-        # Many months store json in this .txt
-        data = json.loads(txt)
-        return data
-    except Exception:
+    r = _SESSION.get(url, timeout=30)
+    if r.status_code == 404:
         return None
+    r.raise_for_status()
+    # Many months store json in this .txt
+    return _json_loads(r.content)
+
+# Per-mon fields normalize_moveset_entry reads; everything else is dropped on load
+MOVESET_FIELDS = ("Abilities", "Items", "Spreads", "Moves", "Tera Types", "Teammates", "Checks and Counters")
 
 def load_moveset_db(month: str, fmt: str, ladder: str) -> Dict[str, Dict]:
     """
@@ -83,17 +209,90 @@ def load_moveset_db(month: str, fmt: str, ladder: str) -> Dict[str, Dict]:
         "Checks and Counters": {"Mon": [probWin, samples], ...} or list
       }
     }
+    Only MOVESET_FIELDS are kept per mon. Results are cached (memory + disk)
+    per (month, fmt, ladder); when both sources 404, {} is cached for
+    STATS_MISS_TTL. Network/server errors return {} uncached.
+    """
+    key = f"{month}:{fmt}:{ladder}"
+    cached = cache_get("moveset", key, _stats_ttl(month))
+    if cached:
+        return cached
+    if cached == {} and cache_get("moveset", key, STATS_MISS_TTL) == {}:
+        return {}
+    data: Dict[str, Dict] = {}
+    n_missing = 0
+    for fetch in (fetch_moveset_chaos, fetch_moveset_fallback):
+        try:
+            doc = fetch(month, fmt, ladder)
+        except Exception:
+            continue
+        if doc is None:
+            n_missing += 1
+        elif "data" in doc:
+            data = doc["data"]
+            break
+    if data:
+        # Keep only the fields we read; drops the rest of the parsed chaos doc
+        data = {mon: {f: entry[f] for f in MOVESET_FIELDS if f in entry} for mon, entry in data.items()}
+        cache_set("moveset", key, data)
+    elif n_missing == 2:
+        cache_set("moveset", key, {})
+    return data
+
+class NormalizedMovesetDB(Mapping):
+    """
+    Read-only view of a raw moveset DB that runs normalize_moveset_entry on
+    first lookup of each mon and keeps the result. A request only reads the
+    ~40 candidates/team members out of hundreds of entries, so the rest are
+    never sorted.
     """
-    chaos = fetch_moveset_chaos(month, fmt, ladder)
-    if chaos and "data" in chaos:
-        return chaos["data"]
-    fallback = fetch_moveset_fallback(month, fmt, ladder)
-    if fallback and "data" in fallback:
-        return fallback["data"]
-    return {}
+    def __init__(self, raw: Dict[str, Dict], top_n_moves: int = 20):
+        self._raw = raw
+        self._top_n_moves = top_n_moves
+        self._norm: Dict[str, Dict] = {}
+
+    def __getitem__(self, mon: str) -> Dict:
+        norm = self._norm.get(mon)
+        if norm is None:
+            norm = normalize_moveset_entry(self._raw[mon], top_n_moves=self._top_n_moves)
+            self._norm[mon] = norm
+        return norm
+
+    def __iter__(self):
+        return iter(self._raw)
+
+    def __len__(self) -> int:
+        return len(self._raw)
+
+    def __contains__(self, mon: object) -> bool:
+        return mon in self._raw
+
+# (month, fmt, ladder, top_n_moves) -> (raw db it was built from, normalized view).
+# LRU-bounded like _MEM_CACHE: each entry pins a multi-MB raw DB, and keys come from requests.
+_NORM_CACHE: "OrderedDict[Tuple[str, str, str, int], Tuple[Dict, NormalizedMovesetDB]]" = OrderedDict()
+NORM_CACHE_MAX_ENTRIES = 8
+
+def load_normalized_moveset_db(month: str, fmt: str, ladder: str, top_n_moves: int = 20) -> NormalizedMovesetDB:
+    """
+    load_moveset_db with entries passed through normalize_moveset_entry (lazily).
+    Memoized for as long as load_moveset_db keeps returning the same raw dict.
+    """
+    raw = load_moveset_db(month, fmt, ladder)
+    key = (month, fmt, ladder, top_n_moves)
+    with _CACHE_LOCK:
+        hit = _NORM_CACHE.get(key)
+        if hit is not None and hit[0] is raw:
+            _NORM_CACHE.move_to_end(key)
+            return hit[1]
+        norm = NormalizedMovesetDB(raw, top_n_moves=top_n_moves)
+        _NORM_CACHE[key] = (raw, norm)
+        _NORM_CACHE.move_to_end(key)
+        while len(_NORM_CACHE) > NORM_CACHE_MAX_ENTRIES:
+            _NORM_CACHE.popitem(last=False)
+    return norm
 
 def _sorted_top(d: Dict[str, float], limit: int) -> List[Tuple[str, float]]:
-    return sorted(d.items(), key=lambda kv: kv[1], reverse=True)[:limit]
+    return heapq.nlargest(limit, d.items(), key=itemgetter(1))
 
 def normalize_moveset_entry(entry: Dict, top_n_moves: int = 12) -> Dict:
     """Pick the top-N fields we care about for prompts/building."""
@@ -121,7 +320,7 @@ def normalize_moveset_entry(entry: Dict, top_n_moves: int = 12) -> Dict:
         for it in checks_raw:
             if isinstance(it, list) and len(it) >= 2:
                 checks.append((str(it[0]), float(it[1])))
-    checks = sorted(checks, key=lambda kv: kv[1], reverse=True)[:12]
+    checks = heapq.nlargest(12, checks, key=itemgetter(1))
     return {
         "abilities": abilities,
         "items": items,
@@ -132,54 +331,147 @@ def normalize_moveset_entry(entry: Dict, top_n_moves: int = 12) -> Dict:
         "checks": checks,
     }
 
-def parse_spread_key(key: str) -> Tuple[str, Dict[str, int]]:
+_SPREAD_RE = re.compile(r"\s*([A-Za-z]+):(\d+)/(\d+)/(\d+)/(\d+)/(\d+)/(\d+)\s*$")
+_SPREAD_STATS = ("HP", "Atk", "Def", "SpA", "SpD", "Spe")
+_DEFAULT_SPREAD = ("Jolly", (0, 252, 0, 0, 4, 252))
+
+def parse_spread_tuple(key: str) -> Tuple[str, Tuple[int, ...]]:
     """
     Key looks like 'Jolly:0/252/0/0/4/252' (HP/Atk/Def/SpA/SpD/Spe).
-    Return (nature, EV dict).
+    Return (nature, EVs in that fixed order); malformed keys give a Jolly offense default.
     """
-    try:
-        nature, nums = key.split(":")
-        parts = [int(x) for x in nums.split("/")]
-        stats = ["HP", "Atk", "Def", "SpA", "SpD", "Spe"]
-        evs = {s: parts[i] if i < len(parts) else 0 for i, s in enumerate(stats)}
-        return nature, evs
-    except Exception:
-        return "Jolly", {"HP": 0, "Atk": 252, "Def": 0, "SpA": 0, "SpD": 4, "Spe": 252}
+    m = _SPREAD_RE.match(key)
+    if not m:
+        return _DEFAULT_SPREAD
+    return m.group(1), tuple(map(int, m.groups()[1:]))
+
+def spread_nature(key: str) -> str:
+    """Just the nature of a spread key (no EV dict built)."""
+    m = _SPREAD_RE.match(key)
+    return m.group(1) if m else _DEFAULT_SPREAD[0]
+
+def parse_spread_key(key: str) -> Tuple[str, Dict[str, int]]:
+    """Like parse_spread_tuple, but returns (nature, EV dict) for set building."""
+    nature, nums = parse_spread_tuple(key)
+    return nature, dict(zip(_SPREAD_STATS, nums))
 
 # -----------------------
 # Strategy Dex scraping (best-effort)
 # -----------------------
+@lru_cache(maxsize=2048)
 def slugify(mon: str) -> str:
-    s = mon.lower().replace(" ", "-")
-    s = re.sub(r"[^a-z0-9\-]", "", s)
-    return s
+    return _SLUG_RE.sub("", mon.lower().translate(_SLUG_TRANS))
 
 def fetch_dex_ou_summary(mon: str) -> Optional[str]:
     """
     Best-effort: fetch the OU dex page and extract some helpful text (first sections).
     If page is client-rendered, we still try to grab visible paragraphs.
+    Summaries are cached on disk for DEX_CACHE_TTL; misses (404, no usable text) are
+    cached as "" for DEX_MISS_TTL so they aren't refetched every run. Network errors aren't cached.
     """
-    url = DEX_OU_URL.format(slug=slugify(mon))
+    slug = slugify(mon)
+    cached = cache_get("dex_ou", slug, DEX_CACHE_TTL)
+    if cached:
+        return cached
+    if cached == "" and cache_get("dex_ou", slug, DEX_MISS_TTL) == "":
+        return None
+    url = DEX_OU_URL.format(slug=slug)
     try:
-        r = requests.get(url, timeout=20)
+        r = _SESSION.get(url, timeout=20)
+        if r.status_code == 404:
+            cache_set("dex_ou", slug, "")
+            return None
         r.raise_for_status()
-        soup = BeautifulSoup(r.text, "lxml")
+        # lxml directly (no BeautifulSoup tree wrapping). lxml ignores the HTTP header and
+        # would default to Latin-1 without a <meta charset>, so pass the header's charset on.
+        has_charset = "charset=" in r.headers.get("Content-Type", "").lower()
+        parser = lxml_html.HTMLParser(encoding=r.encoding) if has_charset and r.encoding else None
+        doc = lxml_html.fromstring(r.content, parser=parser)
 
         # Grab main content paragraphs near the 'Strategy' area
-        # Heuristic: find all <p> under the root content
-        paras = soup.find_all("p")
+        # Heuristic: first <p> elements under the root content
         text_bits: List[str] = []
-        for p in paras[:12]:
-            t = p.get_text(" ", strip=True)
+        for p in itertools.islice(doc.iter("p"), 12):
+            t = " ".join(bit.strip() for bit in p.itertext() if bit.strip())
             if len(t) > 40:
                 text_bits.append(t)
-        if text_bits:
-            # Keep it short; the planner gets many mons
-            return " ".join(text_bits)[:1200]
-        return None
+        # Keep it short; the planner gets many mons ("" if nothing usable)
+        summary = " ".join(text_bits)[:1200]
+        cache_set("dex_ou", slug, summary)
+        return summary or None
     except Exception:
         return None
 
+# -----------------------
+# Candidate context (planner input)
+# -----------------------
+_BLOCK_TEMPLATE = (
+    "=== {mon} ===\n"
+    "[DEX OU SUMMARY]\n{dex}\n"
+    "[STATS] Items: {items} | Abilities: {abilities} | Natures: {natures} | "
+    "Moves: {moves} | Tera: {tera}\n"
+    "Teammates: {mates}\n"
+    "Checks/Counters: {checks}\n"
+)
+# Stats-only variant for candidates past the Dex budget
+_BRIEF_BLOCK_TEMPLATE = (
+    "=== {mon} ===\n"
+    "[STATS] Items: {items} | Abilities: {abilities} | Natures: {natures} | "
+    "Moves: {moves} | Tera: {tera}\n"
+    "Teammates: {mates}\n"
+    "Checks/Counters: {checks}\n"
+)
+
+def _render_block(mon: str, moveset_db: Dict[str, Dict], with_dex: bool = True) -> str:
+    """One per-mon context block (Dex summary + trimmed stats, or stats only)."""
+    dex_summary = (fetch_dex_ou_summary(mon) or "") if with_dex else ""
+    # Entries are already normalized (sorted desc), so slices below are top-N
+    ms = moveset_db.get(mon, {})
+
+    # Trim to keep prompt size reasonable
+    items = ", ".join(k for k, _ in (ms.get("items") or ())[:3]) or "-"
+    abilities = ", ".join(k for k, _ in (ms.get("abilities") or ())[:2]) or "-"
+    natures = ", ".join(dict.fromkeys(spread_nature(sp) for sp, _ in (ms.get("spreads") or ())[:2])) or "-"
+    moves = ", ".join(k for k, _ in (ms.get("moves") or ())[:8]) or "-"
+    tera = ", ".join(k for k, _ in (ms.get("tera") or ())[:3]) or "-"
+    mates = ", ".join(k for k, _ in (ms.get("teammates") or ())[:8]) or "-"
+    checks = ", ".join(k for k, _ in (ms.get("checks") or ())[:8]) or "-"
+
+    template = _BLOCK_TEMPLATE if with_dex else _BRIEF_BLOCK_TEMPLATE
+    return template.format(
+        mon=mon, dex=dex_summary, items=items, abilities=abilities, natures=natures,
+        moves=moves, tera=tera, mates=mates, checks=checks,
+    )
+
+def build_candidate_context(
+    usage: Dict[str, Dict[str, float]],
+    moveset_db: Dict[str, Dict],
+    user_prompt: str,
+    top_k: int = 32,
+    ranked: Optional[List[str]] = None,
+    detailed: int = 12,
+) -> str:
+    """
+    Construct a compact, per-mon context block:
+    - Dex OU summary (first) -- only for the first `detailed` candidates and
+      any mon named in the prompt; the rest get stats only
+    - OU stats: top items, abilities, spreads (nature), moves, tera, teammates, checks
+    """
+    # prioritize mons mentioned in the user prompt
+    mentioned = mentioned_species(usage, user_prompt)
+
+    # `ranked` = species_by_rank(usage), when the caller already has it
+    top_list = ranked[:top_k] if ranked is not None else species_by_rank(usage, top_k)
+    # De-dup with mentioned first; truncate before any fetching
+    cands = list(dict.fromkeys(mentioned + top_list))[:top_k + len(mentioned)]
+    n_detailed = max(detailed, len(mentioned))
+
+    # Dex fetches are independent and network-bound; overlap them
+    with ThreadPoolExecutor(max_workers=16) as ex:
+        blocks = list(ex.map(lambda mon: _render_block(mon, moveset_db), cands[:n_detailed]))
+    blocks.extend(_render_block(mon, moveset_db, with_dex=False) for mon in cands[n_detailed:])
+    return "\n".join(blocks)
+
 # -----------------------
 # Clauses / policies
 # -----------------------
@@ -190,10 +482,11 @@ def load_sv_clauses() -> Dict[str, str]:
         "Evasion Items Clause": "Bright Powder and Lax Incense are banned.",
     }
 
-def banned_sleep_moves() -> Set[str]:
+def banned_sleep_moves() -> FrozenSet[str]:
+    """Shared, immutable policy set; callers may hold on to it across requests."""
     return SLEEP_MOVES
 
-def banned_evasion_items() -> Set[str]:
+def banned_evasion_items() -> FrozenSet[str]:
     return EVASION_ITEMS
 
 def tera_allowed_for_format(fmt: str) -> bool:
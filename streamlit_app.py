@@ -1,88 +1,92 @@
 # streamlit_app.py
+import asyncio
 import os
-from typing import List, Dict
+from typing import TYPE_CHECKING, Dict, FrozenSet, List, Tuple
 
+import httpx
 import streamlit as st
-from openai import OpenAI
+
+if TYPE_CHECKING:
+    from openai import OpenAI
 
 from smogon_utils import (
     fetch_usage_text,
     parse_usage_file,
     get_allowed_species_from_usage,
+    species_by_rank,
     load_sv_clauses,
     banned_sleep_moves,
     banned_evasion_items,
     tera_allowed_for_format,
-    load_moveset_db,
-    normalize_moveset_entry,
-    fetch_dex_ou_summary,
-    parse_spread_key,   # <-- add this
+    load_normalized_moveset_db,
+    build_candidate_context,
 )
 
 from teamgen import (
     build_planner_prompt,
-    call_llm_for_team,         # ← keep this here (top-level import)
+    stream_llm_for_team,
+    call_llm_for_team_async,
+    gather_llm_calls,
     extract_plan_json,
     sets_from_plan,
     normalize_and_validate_sets,
     format_sets_export,
+    ALL_CHECKS_PASSED,
 )
 
 
-# -------------- helpers --------------
-def build_candidate_context(
-    usage: Dict[str, Dict[str, float]],
-    moveset_db_raw: Dict[str, Dict],
-    user_prompt: str,
-    top_k: int = 32,
-) -> str:
+# -------------- cached loaders --------------
+# Survive reruns/clicks within the server process; usage changes at most daily.
+@st.cache_data(ttl=86400, show_spinner=False)
+def _cached_usage(month: str, fmt: str, ladder: str) -> Tuple[str, Dict[str, Dict[str, float]]]:
+    url, txt = fetch_usage_text(month, fmt, ladder)
+    return url, parse_usage_file(txt)
+
+
+@st.cache_resource(ttl=86400, show_spinner=False)
+def _cached_species(month: str, fmt: str, ladder: str) -> Tuple[FrozenSet[str], List[str]]:
+    """(allowed species, species by rank); read-only, so shared instead of copied per call."""
+    _, usage = _cached_usage(month, fmt, ladder)
+    return get_allowed_species_from_usage(usage), species_by_rank(usage)
+
+
+# Bounded: a shared deployment sees many keys, each holding its own keep-alive pool
+@st.cache_resource(max_entries=8, ttl=3600, show_spinner=False)
+def _get_openai(api_key: str) -> "OpenAI":
+    """One client per key, so its keep-alive HTTP/2 pool survives reruns and the report call reuses the planner's connection."""
+    # Imported on first Generate click, not at startup: the SDK import alone is a few hundred ms
+    from openai import OpenAI
+
+    http_client = httpx.Client(
+        http2=True,
+        limits=httpx.Limits(max_connections=16, max_keepalive_connections=8),
+        timeout=httpx.Timeout(180.0, connect=10.0),
+    )
+    return OpenAI(api_key=api_key, http_client=http_client)
+
+
+async def _plan_candidates(
+    api_key: str, sys_p: str, usr_p: str, temperature: float, n: int, use_cache: bool
+) -> List[str]:
     """
-    Construct a compact, per-mon context block:
-    - Dex OU summary (first)
-    - OU stats: top items, abilities, spreads (nature), moves, tera, teammates, checks
+    `n` planner calls in flight at once; temperatures step up from the slider value for variety.
+    Failed calls are dropped, so one 429/timeout doesn't discard the other candidates;
+    if every call failed, the first error is raised (a bad key or exhausted quota won't fix itself on retry).
     """
-    # prioritize mons mentioned in the user prompt
-    mentioned: List[str] = []
-    up = user_prompt.lower()
-    for mon in usage.keys():
-        if mon.lower() in up:
-            mentioned.append(mon)
-
-    top_list = [name for name, _ in sorted(usage.items(), key=lambda kv: kv[1]['rank'])[:top_k]]
-    # De-dup with mentioned first
-    cands: List[str] = []
-    for m in mentioned + top_list:
-        if m not in cands:
-            cands.append(m)
-
-    blocks: List[str] = []
-    for mon in cands[:top_k+len(mentioned)]:
-        dex_summary = fetch_dex_ou_summary(mon) or ""
-        ms = normalize_moveset_entry(moveset_db_raw.get(mon, {}), top_n_moves=12)
-
-        # Trim to keep prompt size reasonable
-        items = ", ".join([f"{k}" for k,_ in (ms.get("items") or [])[:3]]) or "-"
-        abilities = ", ".join([f"{k}" for k,_ in (ms.get("abilities") or [])[:2]]) or "-"
-        nats = []
-        for sp,_ in (ms.get("spreads") or [])[:2]:
-            nat, _ = parse_spread_key(sp)
-            nats.append(nat)
-        natures = ", ".join(dict.fromkeys(nats)) or "-"
-        moves = ", ".join([k for k,_ in (ms.get("moves") or [])[:8]]) or "-"
-        tera = ", ".join([k for k,_ in (ms.get("tera") or [])[:3]]) or "-"
-        mates = ", ".join([k for k,_ in (ms.get("teammates") or [])[:8]]) or "-"
-        checks = ", ".join([k for k,_ in (ms.get("checks") or [])[:8]]) or "-"
-
-        block = (
-            f"=== {mon} ===\n"
-            f"[DEX OU SUMMARY]\n{dex_summary}\n"
-            f"[STATS] Items: {items} | Abilities: {abilities} | Natures: {natures} | "
-            f"Moves: {moves} | Tera: {tera}\n"
-            f"Teammates: {mates}\n"
-            f"Checks/Counters: {checks}\n"
+    from openai import AsyncOpenAI
+
+    temps = [min(1.0, temperature + 0.1 * i) for i in range(n)]
+    # Fresh async client per run: its connection pool is bound to this event loop
+    async with AsyncOpenAI(api_key=api_key) as aclient:
+        results = await gather_llm_calls(
+            (call_llm_for_team_async(aclient, sys_p, usr_p, temperature=t, use_cache=use_cache) for t in temps),
+            return_exceptions=True,
         )
-        blocks.append(block)
-    return "\n".join(blocks)
+    texts = [r for r in results if isinstance(r, str)]
+    if not texts:
+        raise results[0]
+    return texts
+
 
 # -------------- app --------------
 def main():
@@ -105,6 +109,8 @@ def main():
         st.header("Planner")
         top_k = st.slider("Candidate pool size from usage", 12, 48, 32, 4)
         temperature_plan = st.slider("Planner temperature", 0.0, 1.0, 0.35, 0.05)
+        use_plan_cache = st.checkbox("Reuse cached plan for identical inputs (temperature ≤ 0.5)", value=True)
+        n_plans = st.slider("Candidate plans (keep the one needing fewest fixes)", 1, 4, 1)
         st.caption("Planner follows Strategy Dex (~95% weight) and uses OU stats to break ties.")
 
         st.header("Report")
@@ -122,53 +128,68 @@ def main():
             st.error("Please paste your OpenAI API key in the sidebar.")
             st.stop()
 
-        client = OpenAI(api_key=api_key)
+        client = _get_openai(api_key)
 
         # 1) Usage + allowed species
         with st.status("Loading OU usage…", expanded=False) as status:
-            url, txt = fetch_usage_text(month, fmt, ladder)
-            usage = parse_usage_file(txt)
-            allowed_species = get_allowed_species_from_usage(usage)
+            url, usage = _cached_usage(month, fmt, ladder)
+            # ranked: sorted once; sliced for candidates + meta list
+            allowed_species, ranked = _cached_species(month, fmt, ladder)
             status.update(label=f"Loaded usage file: {url}", state="complete")
 
-        # 2) Moveset DB (chaos/moveset)
+        # 2) Moveset DB (chaos/moveset), pre-normalized (memoized) for quick per-mon lookups
         with st.status("Loading OU moveset data…", expanded=False):
-            moveset_db_raw = load_moveset_db(month, fmt, ladder)
-        # Pre-normalize for quick per-mon lookups later
-        moveset_db: Dict[str, Dict] = {}
-        for mon, entry in moveset_db_raw.items():
-            moveset_db[mon] = normalize_moveset_entry(entry, top_n_moves=20)
+            moveset_db = load_normalized_moveset_db(month, fmt, ladder, top_n_moves=20)
 
         # 3) Candidate context (Dex summary + stats)
         with st.status("Compiling candidate context…", expanded=False):
-            cand_ctx = build_candidate_context(usage, moveset_db_raw, user_prompt, top_k=top_k)
+            cand_ctx = build_candidate_context(usage, moveset_db, user_prompt, top_k=top_k, ranked=ranked)
 
         # 4) Planner → JSON team
         sys_p, usr_p = build_planner_prompt(fmt, month, ladder, user_prompt, cand_ctx, ev_target, allow_tera)
-        with st.status("Planning a synergistic team (Dex-guided)…", expanded=False):
-            plan_text = call_llm_for_team(client, sys_p, usr_p, temperature=temperature_plan)
-            plan = extract_plan_json(plan_text)
-
-        # 5) Convert plan → PokeSets (fill with stats when missing)
+        # Expanded while a single plan streams in, so progress is visible from the first token
+        with st.status("Planning a synergistic team (Dex-guided)…", expanded=(n_plans == 1)) as plan_status:
+            if n_plans == 1:
+                plan_texts = [st.write_stream(stream_llm_for_team(client, sys_p, usr_p, temperature=temperature_plan, use_cache=use_plan_cache))]
+                plan_status.update(expanded=False)
+            else:
+                plan_texts = asyncio.run(_plan_candidates(api_key, sys_p, usr_p, temperature_plan, n_plans, use_plan_cache))
+            plans = []
+            for plan_text in plan_texts:
+                try:
+                    plans.append(extract_plan_json(plan_text))
+                except Exception:
+                    pass
+            if not plans:
+                st.error("The planner did not return a usable JSON plan; try again.")
+                st.stop()
+
+        # 5) Convert plan(s) → PokeSets (fill with stats when missing)
         with st.status("Converting plan to sets…", expanded=False):
-            sets = sets_from_plan(plan, moveset_db, tera_allowed=allow_tera)
+            candidate_sets = [sets_from_plan(plan, moveset_db, tera_allowed=allow_tera) for plan in plans]
 
-        # 6) Validate & repair for legality, EVs, 4 moves, etc.
+        # 6) Validate & repair for legality, EVs, 4 moves, etc.; keep the candidate needing the fewest fixes
         clauses = load_sv_clauses()
         sleep_ban = banned_sleep_moves()
         evasion_items = banned_evasion_items()
         with st.status("Validating & fixing legality…", expanded=False):
-            sets_valid, legality_report = normalize_and_validate_sets(
-                sets=sets,
-                allowed_species=allowed_species,
-                usage=usage,
-                ev_target=ev_target,
-                enforce_species_clause=enforce_species_clause,
-                ban_sleep_moves=sleep_ban,
-                ban_items=evasion_items,
-                tera_allowed=allow_tera,
-                moveset_db=moveset_db,
-            )
+            best = None
+            for sets in candidate_sets:
+                sets_valid, legality_report = normalize_and_validate_sets(
+                    sets=sets,
+                    allowed_species=allowed_species,
+                    usage=usage,
+                    ev_target=ev_target,
+                    enforce_species_clause=enforce_species_clause,
+                    ban_sleep_moves=sleep_ban,
+                    ban_items=evasion_items,
+                    tera_allowed=allow_tera,
+                    moveset_db=moveset_db,
+                )
+                n_fixes = 0 if legality_report == ALL_CHECKS_PASSED else legality_report.count("\n") + 1
+                if best is None or n_fixes < best[0]:
+                    best = (n_fixes, sets_valid, legality_report)
+            _, sets_valid, legality_report = best
 
         export = format_sets_export(sets_valid, allow_tera)
 
@@ -188,7 +209,7 @@ def main():
         if want_report:
             st.divider()
             st.subheader("Team Report (Smogon RMT style)")
-            meta20 = ", ".join([name for name, _ in sorted(usage.items(), key=lambda kv: kv[1]['rank'])[:20]])
+            meta20 = ", ".join(ranked[:20])
             sys_r = f"""
 You are a Smogon RMT ghostwriter. Produce a Markdown RMT with sections:
 I. Introduction
@@ -215,8 +236,7 @@ User prompt:
 
 If helpful, you may reference typical partners/counters (from OU stats knowledge), but do not repeat the full export again—just analysis.
 """
-            report_md = call_llm_for_team(client, sys_r, usr_r, temperature=0.65)
-            st.markdown(report_md)
+            report_md = st.write_stream(stream_llm_for_team(client, sys_r, usr_r, temperature=0.65))
             st.download_button("Download report.md", report_md.encode("utf-8"), file_name=f"{fmt}-{month}-report.md", mime="text/markdown")
 
 
@@ -1,14 +1,32 @@
 # teamgen.py
+import asyncio
+import hashlib
+import heapq
 import json
 import re
+import sys
 from dataclasses import dataclass
-from typing import List, Dict, Tuple, Set, Optional
+from functools import lru_cache
+from typing import Awaitable, FrozenSet, Iterable, Iterator, List, Dict, Tuple, Set, Optional, Union
+
+try:
+    import orjson  # optional; faster plan parsing
+    _json_loads = orjson.loads
+except ImportError:
+    _json_loads = json.loads
 
 # If you want to use top spreads from stats when the plan omits them:
 # You'll pass parse_spread_key in via smogon_utils (streamlit_app already has that context).
 try:
-    from smogon_utils import parse_spread_key  # optional import; only used if available
+    from smogon_utils import parse_spread_key, species_by_rank, cache_get, cache_set  # optional import; only used if available
 except Exception:
+    # No smogon_utils: LLM responses just aren't cached
+    def cache_get(namespace: str, key: str, ttl: float):
+        return None
+
+    def cache_set(namespace: str, key: str, value) -> None:
+        pass
+
     def parse_spread_key(key: str):
         # Fallback parser: "Jolly:0/252/0/0/4/252"
         try:
@@ -20,12 +38,15 @@ except Exception:
         except Exception:
             return "Jolly", {"HP": 0, "Atk": 252, "Def": 0, "SpA": 0, "SpD": 4, "Spe": 252}
 
+    def species_by_rank(usage: Dict[str, Dict[str, float]], n: Optional[int] = None) -> List[str]:
+        return heapq.nsmallest(len(usage) if n is None else n, usage, key=lambda name: usage[name]["rank"])
+
 
 # =========================
 # Data structures
 # =========================
 
-@dataclass
+@dataclass(slots=True)
 class PokeSet:
     name: str
     item: str
@@ -37,24 +58,154 @@ class PokeSet:
     moves: List[str]
 
 
-STAT_ORDER = ["HP", "Atk", "Def", "SpA", "SpD", "Spe"]
+# Interned so EV/IV dict lookups keyed by these names hit on identity
+STAT_ORDER = tuple(sys.intern(s) for s in ("HP", "Atk", "Def", "SpA", "SpD", "Spe"))
 
 
 # =========================
 # LLM wrapper
 # =========================
 
-def call_llm_for_team(client, system_prompt: str, user_message: str, temperature: float = 0.6) -> str:
-    """Light wrapper for Responses API."""
+PLANNER_MODEL = "gpt-4o-mini"
+LLM_CACHE_TTL = 7 * 24 * 3600
+LLM_CACHE_MAX_TEMPERATURE = 0.5  # hotter calls are meant to vary; never cached
+
+
+def _llm_cache_key(model: str, system_prompt: str, user_message: str, temperature: float) -> str:
+    h = hashlib.blake2b(digest_size=20)
+    for part in (model, f"{temperature:.3f}", system_prompt, user_message):
+        h.update(part.encode("utf-8"))
+        h.update(b"\0")
+    return h.hexdigest()
+
+
+def _llm_lookup(system_prompt: str, user_message: str, temperature: float, use_cache: bool) -> Tuple[Optional[str], Optional[str]]:
+    """(cache key or None if uncacheable, cached text or None)."""
+    if not use_cache or temperature > LLM_CACHE_MAX_TEMPERATURE:
+        return None, None
+    key = _llm_cache_key(PLANNER_MODEL, system_prompt, user_message, temperature)
+    return key, cache_get("llm", key, LLM_CACHE_TTL)
+
+
+def _llm_input(system_prompt: str, user_message: str) -> List[Dict[str, str]]:
+    return [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": user_message},
+    ]
+
+
+def call_llm_for_team(
+    client,
+    system_prompt: str,
+    user_message: str,
+    temperature: float = 0.6,
+    use_cache: bool = True,
+) -> str:
+    """
+    Light wrapper for Responses API.
+    Low-temperature calls are cached on the exact (model, temperature, prompts).
+    """
+    key, cached = _llm_lookup(system_prompt, user_message, temperature, use_cache)
+    if cached is not None:
+        return cached
     resp = client.responses.create(
-        model="gpt-4o-mini",
+        model=PLANNER_MODEL,
         temperature=temperature,
-        input=[
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": user_message},
-        ],
+        input=_llm_input(system_prompt, user_message),
+    )
+    text = resp.output_text
+    if key is not None and text:
+        cache_set("llm", key, text)
+    return text
+
+
+def stream_llm_for_team(
+    client,
+    system_prompt: str,
+    user_message: str,
+    temperature: float = 0.6,
+    use_cache: bool = True,
+) -> Iterator[str]:
+    """
+    call_llm_for_team, but yields text deltas as they arrive (e.g. for st.write_stream).
+    A cache hit comes back as one chunk; a finished stream is cached like the blocking call.
+    """
+    key, cached = _llm_lookup(system_prompt, user_message, temperature, use_cache)
+    if cached is not None:
+        yield cached
+        return
+    parts: List[str] = []
+    with client.responses.stream(
+        model=PLANNER_MODEL,
+        temperature=temperature,
+        input=_llm_input(system_prompt, user_message),
+    ) as stream:
+        for event in stream:
+            if event.type == "response.output_text.delta":
+                parts.append(event.delta)
+                yield event.delta
+    text = "".join(parts)
+    if key is not None and text:
+        cache_set("llm", key, text)
+
+
+async def call_llm_for_team_async(
+    client,
+    system_prompt: str,
+    user_message: str,
+    temperature: float = 0.6,
+    use_cache: bool = True,
+) -> str:
+    """call_llm_for_team for an AsyncOpenAI client (same model, same cache)."""
+    key, cached = _llm_lookup(system_prompt, user_message, temperature, use_cache)
+    if cached is not None:
+        return cached
+    resp = await client.responses.create(
+        model=PLANNER_MODEL,
+        temperature=temperature,
+        input=_llm_input(system_prompt, user_message),
+    )
+    text = resp.output_text
+    if key is not None and text:
+        cache_set("llm", key, text)
+    return text
+
+
+async def gather_llm_calls(
+    coros: Iterable[Awaitable[str]], max_concurrency: int = 8, return_exceptions: bool = False
+) -> List[Union[str, BaseException]]:
+    """
+    Await LLM call coroutines concurrently (results in input order), at most `max_concurrency` in flight.
+    By default the first failure (429, timeout) is raised and every other result is lost
+    (the other calls are not cancelled); with return_exceptions=True it comes back in its
+    slot as the exception instead.
+    """
+    sem = asyncio.Semaphore(max_concurrency)
+
+    async def _bounded(coro: Awaitable[str]) -> str:
+        async with sem:
+            return await coro
+
+    return list(await asyncio.gather(*(_bounded(c) for c in coros), return_exceptions=return_exceptions))
+
+
+async def generate_teams_batch(
+    client,
+    prompts: Iterable[Tuple[str, str]],
+    temperature: float = 0.6,
+    max_concurrency: int = 8,
+    use_cache: bool = True,
+) -> List[Union[str, BaseException]]:
+    """
+    Planner output for each (system, user) prompt pair, e.g. one per (format, month),
+    requested concurrently on an AsyncOpenAI client. Results are in input order; a failed
+    call is returned as its exception so one 429/timeout doesn't lose the whole batch.
+    """
+    return await gather_llm_calls(
+        (call_llm_for_team_async(client, s, u, temperature=temperature, use_cache=use_cache) for s, u in prompts),
+        max_concurrency=max_concurrency,
+        return_exceptions=True,
     )
-    return resp.output_text
 
 
 # =========================
@@ -87,7 +238,7 @@ Hard rules for the JSON you output:
     - "item": legal item string
     - "ability": legal ability string
     - "nature": legal nature string
-    - "evs": object with keys {STAT_ORDER} (integers, multiples of 4, each ≤ 252, SUM = {ev_target})
+    - "evs": object with keys {list(STAT_ORDER)} (integers, multiples of 4, each ≤ 252, SUM = {ev_target})
     - "tera": null if Tera is not allowed; else a single type string (e.g., "Water") or null if not needed
     - "moves": array of **exactly 4** legal moves
     - "rationale": 1–3 sentences on why this set fits the team
@@ -108,18 +259,30 @@ spreads/natures, moves, tera, teammates, checks). Prefer Dex guidance; use stats
     return sys, usr
 
 
+TRAILING_JSON_RE = re.compile(r"\{[\s\S]*\}\s*$")
+
+
+def _strip_codefence(text: str) -> str:
+    """Strip surrounding whitespace and a ```lang fence if present; unfenced text never touches a regex."""
+    t = text.strip()
+    if t[:3] != "```":
+        return t
+    t = t.strip("` \n")
+    nl = t.find("\n")
+    if nl > 0 and t[:nl].isalnum():  # remove language hint
+        t = t[nl + 1:]
+    return t
+
+
 def extract_plan_json(text: str) -> Dict:
     """Robustly parse the planner's JSON (strip codefences if present)."""
-    t = text.strip()
-    if t.startswith("```"):
-        t = t.strip("` \n")
-        t = re.sub(r"^\w+\n", "", t)  # remove language hint
+    t = _strip_codefence(text)
     try:
-        return json.loads(t)
+        return _json_loads(t)
     except Exception:
-        m = re.search(r"\{[\s\S]*\}\s*$", t)
+        m = TRAILING_JSON_RE.search(t)
         if m:
-            return json.loads(m.group(0))
+            return _json_loads(m.group(0))
         raise
 
 
@@ -127,6 +290,7 @@ def extract_plan_json(text: str) -> Dict:
 # From plan → PokeSet list
 # =========================
 
+@lru_cache(maxsize=4096)
 def _sanitize_move(m: str) -> str:
     return m.replace("-", " ").strip().title()
 
@@ -204,43 +368,28 @@ def sets_from_plan(
 # =========================
 
 SET_SPLIT_RE = re.compile(r"\n\s*\n+")
-NAME_ITEM_RE = re.compile(r"^([^@\n]+?)\s*@\s*(.+)$")
-ABILITY_RE = re.compile(r"^Ability:\s*(.+)$", re.I)
-TERA_RE = re.compile(r"^Tera Type:\s*(.+)$", re.I)
-EVS_RE = re.compile(r"^EVs:\s*(.+)$", re.I)
-NATURE_RE = re.compile(r"^(\w+)\s+Nature$", re.I)
-IVS_RE = re.compile(r"^IVs:\s*(.+)$", re.I)
+STAT_TOKEN_RE = re.compile(r"(\d+)\s*(HP|Atk|Def|SpA|SpD|Spe)")
 
 def extract_sets(raw: str) -> List[str]:
-    raw = raw.strip()
-    if raw.startswith("```"):
-        raw = raw.strip("`\n ")
-        raw = re.sub(r"^\w+\n", "", raw)
-    return [p.strip() for p in SET_SPLIT_RE.split(raw) if p.strip()][:6]
+    raw = _strip_codefence(raw)
+    # Exports almost always separate mons with exactly one blank line: plain split first,
+    # regex when that misses a team or leaves a separator inside a kept block
+    # (whitespace-only lines, \r\n, ...)
+    parts = [s for s in (p.strip() for p in raw.split("\n\n")) if s]
+    if len(parts) < 6 or any(SET_SPLIT_RE.search(p) for p in parts[:6]):
+        parts = [s for s in (p.strip() for p in SET_SPLIT_RE.split(raw)) if s]
+    return parts[:6]
 
 
 def _parse_evs(evs_line: str) -> Dict[str, int]:
-    pieces = [p.strip() for p in evs_line.split("/")]
-    evs: Dict[str, int] = {s: 0 for s in STAT_ORDER}
-    for p in pieces:
-        m = re.match(r"(\d+)\s*(HP|Atk|Def|SpA|SpD|Spe)", p)
-        if m:
-            evs[m.group(2)] = int(m.group(1))
+    # One findall over the whole "252 Atk / 4 SpD / 252 Spe" line
+    evs: Dict[str, int] = dict.fromkeys(STAT_ORDER, 0)
+    evs.update({stat: int(num) for num, stat in STAT_TOKEN_RE.findall(evs_line)})
     return evs
 
 
 def _parse_ivs(ivs_line: str) -> Dict[str, int]:
-    pieces = [p.strip() for p in ivs_line.split("/")]
-    ivs: Dict[str, int] = {}
-    for p in pieces:
-        m = re.match(r"(\d+)\s*(HP|Atk|Def|SpA|SpD|Spe)", p)
-        if m:
-            ivs[m.group(2)] = int(m.group(1))
-    if not ivs:
-        m2 = re.match(r"(\d+)\s*(HP|Atk|Def|SpA|SpD|Spe)", ivs_line.strip())
-        if m2:
-            ivs[m2.group(2)] = int(m2.group(1))
-    return ivs
+    return {sys.intern(stat): int(num) for num, stat in STAT_TOKEN_RE.findall(ivs_line)}
 
 
 # =========================
@@ -251,67 +400,64 @@ def _snap_target(total: int) -> int:
     total = max(0, min(510, total))
     return total - (total % 4)
 
+# Priority for closing the gap to the EV target (same order whether filling or draining)
+EV_FILL_ORDER = ("HP", "SpD", "Spe", "Def", "SpA", "Atk")
+
+
+def _round_robin_units(caps: List[int], n: int) -> List[int]:
+    """
+    Hand out n units one per slot per round, in slot order, skipping slots at their cap;
+    returns the units per slot. Closed form: level k = full rounds everyone still open
+    gets, then the leftover (< open slots) goes to the first open slots.
+    """
+    k, rest, open_slots = 0, n, len(caps)
+    for cap in sorted(caps):
+        fill = (cap - k) * open_slots
+        if fill > rest:
+            k += rest // open_slots
+            rest %= open_slots
+            break
+        rest -= fill
+        k = cap
+        open_slots -= 1
+    out = []
+    for cap in caps:
+        units = min(cap, k)
+        if rest and cap > k:
+            units += 1
+            rest -= 1
+        out.append(units)
+    return out
+
+
 def _ev_fixup(evs: Dict[str, int], target: int) -> Dict[str, int]:
     """
     Make EVs legal & aim for target:
     - target snapped to multiple of 4 within 0..510
     - per-stat clamp 0..252
     - all multiples of 4
-    - redistribute in steps of 4 w/out infinite loops
+    - close the gap round-robin in EV_FILL_ORDER, 4 EVs per stat per round, so a
+      large gap is spread across stats (computed in closed form, not stepped)
     """
     target = _snap_target(target)
-    adj = {}
-    for s in STAT_ORDER:
-        v = int(evs.get(s, 0))
-        v = max(0, min(252, v))
-        v -= (v % 4)
-        adj[s] = v
-    total = sum(adj.values())
+    adj = {s: max(0, min(252, int(evs.get(s, 0)))) // 4 * 4 for s in STAT_ORDER}
 
     # Seed an offensive default if empty and target > 0
-    if total == 0 and target > 0:
-        adj = {s: 0 for s in STAT_ORDER}
+    if target > 0 and not any(adj.values()):
         adj["Atk"] = 252
         adj["Spe"] = 252
         adj["SpD"] = 4
-        total = sum(adj.values())
-
-    incr_order = ["HP", "SpD", "Spe", "Def", "SpA", "Atk"]
-    decr_order = ["HP", "SpD", "Spe", "Def", "SpA", "Atk"]
-
-    # Reduce
-    steps = 0
-    while total > target and steps < 300:
-        moved = False
-        for s in decr_order:
-            if total == target:
-                break
-            if adj[s] >= 4:
-                adj[s] -= 4
-                total -= 4
-                moved = True
-        if not moved:
-            break
-        steps += 1
-
-    # Increase
-    steps = 0
-    while total < target and steps < 300:
-        moved = False
-        for s in incr_order:
-            if total == target:
-                break
-            if adj[s] <= 248:
-                adj[s] += 4
-                total += 4
-                moved = True
-        if not moved:
-            break
-        steps += 1
 
-    # Final clean
-    for s in STAT_ORDER:
-        adj[s] = max(0, min(252, adj[s] - (adj[s] % 4)))
+    # Both sides are multiples of 4, so delta is too
+    delta = target - sum(adj.values())
+    if delta > 0:
+        room = [(252 - adj[s]) // 4 for s in EV_FILL_ORDER]
+        for s, units in zip(EV_FILL_ORDER, _round_robin_units(room, delta // 4)):
+            adj[s] += 4 * units
+    elif delta < 0:
+        room = [adj[s] // 4 for s in EV_FILL_ORDER]
+        for s, units in zip(EV_FILL_ORDER, _round_robin_units(room, -delta // 4)):
+            adj[s] -= 4 * units
     return adj
 
 
@@ -319,7 +465,7 @@ def _sanitize_item(item: str) -> str:
     return (item or "").strip() or "Leftovers"
 
 
-def _legalize_item(item: str, ban_items: Set[str]) -> str:
+def _legalize_item(item: str, ban_items: FrozenSet[str]) -> str:
     item = _sanitize_item(item)
     return "Leftovers" if item in ban_items else item
 
@@ -328,14 +474,18 @@ def _legalize_item(item: str, ban_items: Set[str]) -> str:
 # Final legality/normalization + export
 # =========================
 
+ALL_CHECKS_PASSED = "All checks passed."  # report for a team that needed no fixes
+FALLBACK_MOVES = ("Protect", "U-turn", "Knock Off", "Earthquake", "Shadow Ball", "Moonblast", "Flamethrower", "Surf")
+
+
 def normalize_and_validate_sets(
     sets: List[PokeSet],
-    allowed_species: Set[str],
+    allowed_species: Iterable[str],
     usage: Dict[str, Dict[str, float]],
     ev_target: int,
     enforce_species_clause: bool,
-    ban_sleep_moves: Set[str],
-    ban_items: Set[str],
+    ban_sleep_moves: Iterable[str],
+    ban_items: Iterable[str],
     tera_allowed: bool,
     moveset_db: Optional[Dict[str, Dict]] = None,
 ) -> Tuple[List[PokeSet], str]:
@@ -349,16 +499,28 @@ def normalize_and_validate_sets(
     report_lines: List[str] = []
     parsed: List[PokeSet] = []
 
+    # Callers may pass lists; frozenset() of the shared policy frozensets is free
+    allowed_species = frozenset(allowed_species)
+    ban_items = frozenset(ban_items)
+    is_banned_move = frozenset(ban_sleep_moves).__contains__
+
     ev_target_snapped = _snap_target(ev_target)
     if ev_target_snapped != ev_target:
         report_lines.append(f"[EV] Requested total {ev_target} is not a multiple of 4; using {ev_target_snapped}.")
     ev_target = ev_target_snapped
 
+    # Top usage names by rank; built at most once, and only if a replacement is needed.
+    # len(sets) names suffice: set i takes index <= i, and a duplicate has at most
+    # len(sets)-1 names already seen, so a free one is always within the first len(sets).
+    legal_sorted: Optional[List[str]] = None
+    n_legal = len(sets)
+
     for i, ps in enumerate(sets):
         # Species legality
         if ps.name not in allowed_species:
-            legal_sorted = sorted(usage.items(), key=lambda kv: kv[1]['rank'])
-            replacement = legal_sorted[min(i, len(legal_sorted)-1)][0]
+            if legal_sorted is None:
+                legal_sorted = species_by_rank(usage, n_legal)
+            replacement = legal_sorted[min(i, len(legal_sorted)-1)]
             report_lines.append(f"[{i+1}] Replaced illegal species '{ps.name}' → '{replacement}'.")
             ps.name = replacement
 
@@ -374,7 +536,7 @@ def normalize_and_validate_sets(
         cleaned: List[str] = []
         for mv in moves_in:
             mm = _sanitize_move(mv)
-            if mm and mm not in ban_sleep_moves:
+            if mm and not is_banned_move(mm):
                 cleaned.append(mm)
 
         if len(cleaned) < 4:
@@ -384,17 +546,17 @@ def normalize_and_validate_sets(
                 top_moves = moveset_db[ps.name]["moves"]  # list of (name, pct)
             for mv, _pct in top_moves:
                 mm = _sanitize_move(mv)
-                if mm not in cleaned and mm not in ban_sleep_moves:
+                if mm not in cleaned and not is_banned_move(mm):
                     cleaned.append(mm)
                 if len(cleaned) == 4:
                     break
         # Absolute fallbacks
-        fallbacks = ["Protect", "U-turn", "Knock Off", "Earthquake", "Shadow Ball", "Moonblast", "Flamethrower", "Surf"]
-        while len(cleaned) < 4:
-            for mm in fallbacks:
-                if mm not in cleaned and mm not in ban_sleep_moves:
+        if len(cleaned) < 4:
+            for mm in FALLBACK_MOVES:
+                if mm not in cleaned and not is_banned_move(mm):
                     cleaned.append(mm)
-                    break
+                    if len(cleaned) == 4:
+                        break
 
         ps.moves = cleaned[:4]
 
@@ -407,34 +569,43 @@ def normalize_and_validate_sets(
     # Species Clause (no duplicates)
     if enforce_species_clause:
         seen: Set[str] = set()
+        clause_idx = 0  # `seen` only grows, so names skipped once never need rechecking
         for i, ps in enumerate(parsed):
             if ps.name in seen:
-                for cand, _meta in sorted(usage.items(), key=lambda kv: kv[1]['rank']):
-                    if cand not in seen:
-                        report_lines.append(f"[{i+1}] Species Clause: replaced duplicate '{ps.name}' → '{cand}'.")
-                        ps.name = cand
-                        break
+                if legal_sorted is None:
+                    legal_sorted = species_by_rank(usage, n_legal)
+                while clause_idx < len(legal_sorted) and legal_sorted[clause_idx] in seen:
+                    clause_idx += 1
+                if clause_idx < len(legal_sorted):
+                    cand = legal_sorted[clause_idx]
+                    report_lines.append(f"[{i+1}] Species Clause: replaced duplicate '{ps.name}' → '{cand}'.")
+                    ps.name = cand
             seen.add(ps.name)
 
-    return parsed, "\n".join(report_lines) if report_lines else "All checks passed."
+    return parsed, "\n".join(report_lines) if report_lines else ALL_CHECKS_PASSED
 
 
 def format_sets_export(sets: List[PokeSet], allow_tera: bool) -> str:
-    out_blocks: List[str] = []
+    # One flat list of lines for the whole team, joined once ("" = blank line between mons)
+    lines: List[str] = []
     for ps in sets:
-        lines = [f"{ps.name} @ {ps.item}", f"Ability: {ps.ability or '—'}"]
+        if lines:
+            lines.append("")
+        lines.append(f"{ps.name} @ {ps.item}")
+        lines.append(f"Ability: {ps.ability or '—'}")
         if allow_tera and ps.tera:
             lines.append(f"Tera Type: {ps.tera}")
-        ev_parts = [f"{ps.evs.get(s,0)} {s}" for s in STAT_ORDER if ps.evs.get(s,0) > 0]
-        if ev_parts:
-            lines.append("EVs: " + " / ".join(ev_parts))
+        evs = ps.evs
+        if evs:  # no EVs line at all for an empty spread
+            ev_parts = [f"{v} {s}" for s in STAT_ORDER if (v := evs.get(s, 0)) > 0]
+            if ev_parts:
+                lines.append("EVs: " + " / ".join(ev_parts))
         lines.append(f"{ps.nature or 'Jolly'} Nature")
-        if ps.ivs:
-            iv_parts = [f"{ps.ivs.get(s)} {s}" for s in STAT_ORDER if ps.ivs.get(s) is not None]
+        ivs = ps.ivs
+        if ivs:
+            iv_parts = [f"{v} {s}" for s in STAT_ORDER if (v := ivs.get(s)) is not None]
             if iv_parts:
                 lines.append("IVs: " + " / ".join(iv_parts))
         # Exactly 4 moves
-        for mv in (ps.moves or [])[:4]:
-            lines.append(mv)
-        out_blocks.append("\n".join(lines))
-    return "\n\n".join(out_blocks)
+        lines.extend((ps.moves or [])[:4])
+    return "\n".join(lines)